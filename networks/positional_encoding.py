@@ -1,15 +1,15 @@
+import functools
+
 import torch
+import torch.nn as nn
 import torchvision
-import pydicom
-import PIL
-import cv2
+from torchvision.transforms import InterpolationMode
+from torchvision.transforms.v2 import functional as TF
 from PIL import Image
 
 import numpy as np
 import tqdm
 
-import matplotlib.pyplot as plt
-
 
 def crop_image(img, d=32):
     '''Make dimensions divisible by `d`'''
@@ -36,16 +36,19 @@ def get_params(opt_over, net, net_input, downsampler=None):
         net: network
         net_input: torch.Tensor that stores input `z`
     '''
+    if opt_over == 'net':
+        return list(net.parameters())
+
     opt_over_list = opt_over.split(',')
     params = []
 
     for opt in opt_over_list:
 
         if opt == 'net':
-            params += [x for x in net.parameters()]
+            params.extend(net.parameters())
         elif opt == 'down':
             assert downsampler is not None
-            params = [x for x in downsampler.parameters()]
+            params.extend(downsampler.parameters())
         elif opt == 'input':
             if net_input.is_leaf:
                 net_input.requires_grad = True
@@ -56,14 +59,28 @@ def get_params(opt_over, net, net_input, downsampler=None):
     return params
 
 
+@torch.inference_mode()
 def get_image_grid(images_np, nrow=8):
     '''Creates a grid from a list of images by concatenating them.'''
+    n = len(images_np)
+    if n > 1 and n % nrow == 0 and images_np[0].ndim == 3 and all(x.shape == images_np[0].shape for x in images_np):
+        # Uniform images filling whole rows: same layout as make_grid(padding=2) in one reshape
+        ar = np.stack(images_np)
+        if ar.shape[1] == 1:
+            ar = np.repeat(ar, 3, axis=1)
+        C, H, W = ar.shape[1:]
+        ar = np.pad(ar, ((0, 0), (0, 0), (2, 0), (2, 0)))
+        grid = ar.reshape(n // nrow, nrow, C, H + 2, W + 2).transpose(2, 0, 3, 1, 4)
+        grid = grid.reshape(C, n // nrow * (H + 2), nrow * (W + 2))
+        return np.pad(grid, ((0, 0), (0, 2), (0, 2)))
+
     images_torch = [torch.from_numpy(x) for x in images_np]
     torch_grid = torchvision.utils.make_grid(images_torch, nrow)
 
     return torch_grid.numpy()
 
 
+@torch.inference_mode()
 def plot_image_grid(images_np, nrow=8, factor=1, interpolation='lanczos'):
     """Draws images in a grid
 
@@ -73,6 +90,8 @@ def plot_image_grid(images_np, nrow=8, factor=1, interpolation='lanczos'):
         factor: size if the plt.figure
         interpolation: interpolation used in plt.imshow
     """
+    import matplotlib.pyplot as plt
+
     n_channels = max(x.shape[0] for x in images_np)
 
     assert (n_channels == 3) or (n_channels == 1), "images should have 1 or 3 channels"
@@ -96,6 +115,8 @@ def plot_image_grid(images_np, nrow=8, factor=1, interpolation='lanczos'):
 def load(path):
     """Load PIL image."""
     if path[-4:] == ".dcm":
+        import pydicom
+
         img = pydicom.read_file(path)
         img = img.pixel_array
         img = (img - img.min()) / img.max()
@@ -106,6 +127,20 @@ def load(path):
     return img
 
 
+@functools.lru_cache(maxsize=32)
+def _decoded(path):
+    '''Returns the image at `path` as a fully decoded PIL image, cached per path.
+
+    Caching the image rather than its pixel array keeps the mode and palette, so 'P', 'CMYK',
+    16-bit and bilevel images come back exactly as `load` returns them. The image is shared
+    between calls, so callers should `.copy()` it; edits to the file on disk are not picked up
+    once it is cached.
+    '''
+    img = load(path)
+    img.load()
+    return img
+
+
 def get_image(path, imsize=-1):
     """Load an image and resize to a cpecific size.
 
@@ -113,16 +148,23 @@ def get_image(path, imsize=-1):
         path: path to image
         imsize: tuple or scalar with dimensions; -1 for `no resize`
     """
-    img = load(path)
+    img = _decoded(path).copy()
 
     if isinstance(imsize, int):
         imsize = (imsize, imsize)
 
-    if imsize[0] != -1 and img.size != imsize:
-        if imsize[0] > img.size[0]:
-            img = img.resize(imsize, Image.BICUBIC)
+    if imsize[0] != -1 and img.size != tuple(imsize):
+        if img.mode not in ('RGB', 'L'):
+            # Only plain 8-bit colour/gray is safe to interpolate as-is: PIL resizes 'P' and '1' with
+            # NEAREST, premultiplies alpha, and handles 16-bit and other colour spaces itself
+            img = img.resize(imsize, Image.BICUBIC if imsize[0] > img.size[0] else Image.LANCZOS)
         else:
-            img = img.resize(imsize, Image.ANTIALIAS)
+            img_t = TF.pil_to_tensor(img)
+            if torch.cuda.is_available():
+                img_t = img_t.cuda()
+            # `imsize` is (W, H) like PIL; antialias keeps downscaling close to PIL's filtered resize
+            img_t = TF.resize(img_t, [imsize[1], imsize[0]], interpolation=InterpolationMode.BICUBIC, antialias=True)
+            img = TF.to_pil_image(img_t.cpu())
 
     img_np = pil_to_np(img)
 
@@ -139,16 +181,25 @@ def fill_noise(x, noise_type):
         assert False
 
 
-def get_meshgrid(spatial_size):
-    # X, Y = np.meshgrid(np.arange(1-spatial_size[1], spatial_size[1], 2) / float(spatial_size[1] - 1),
-    #                    np.arange(1-spatial_size[0], spatial_size[0], 2) / float(spatial_size[0] - 1))
-    X, Y = np.meshgrid(np.arange(0, spatial_size[1]) / float(spatial_size[1] - 1),
-                       np.arange(0, spatial_size[0]) / float(spatial_size[0] - 1))
-    meshgrid = np.concatenate([X[None, :], Y[None, :]])
-    return meshgrid
+def get_meshgrid(spatial_size, device='cpu', dtype=torch.float32):
+    '''Returns a (2 x H x W) grid of [0, 1] coordinates, X first, built directly on `device`.'''
+    ys = torch.linspace(0, 1, spatial_size[0], device=device, dtype=dtype)
+    xs = torch.linspace(0, 1, spatial_size[1], device=device, dtype=dtype)
+    Y, X = torch.meshgrid(ys, xs, indexing='ij')
+    return torch.stack([X, Y], dim=0)
+
 
+@functools.lru_cache(maxsize=8)
+def _cached_meshgrid(spatial_size, device, dtype):
+    '''Returns the (2 x H x W) coordinate grid for `spatial_size`, built once per size/device/dtype.
 
-def get_input(input_depth, method, spatial_size, noise_type='u', var=1. / 10, freq_dict='log'):
+    The result is shared between calls and must not be modified in place.
+    '''
+    return get_meshgrid(spatial_size, device, dtype)
+
+
+def get_input(input_depth, method, spatial_size, noise_type='u', var=1. / 10, freq_dict='log', device='cpu',
+              dtype=None):
     """Returns a pytorch.Tensor of size (1 x `input_depth` x `spatial_size[0]` x `spatial_size[1]`)
     initialized in a specific way.
     Args:
@@ -157,29 +208,34 @@ def get_input(input_depth, method, spatial_size, noise_type='u', var=1. / 10, fr
         spatial_size: spatial size of the tensor to initialize
         noise_type: 'u' for uniform; 'n' for normal
         var: a factor, a noise will be multiplicated by. Basically it is standard deviation scaler.
+        device: device the tensor is created on, so CUDA inputs are generated there directly
+        dtype: dtype of the tensor; None means float32, except `fourier` features on CUDA which use bfloat16.
     """
     if isinstance(spatial_size, int):
         spatial_size = (spatial_size, spatial_size)
     if method == 'noise':
         shape = [1, input_depth, spatial_size[0], spatial_size[1]]
-        net_input = torch.zeros(shape)
+        net_input = torch.empty(shape, device=device, dtype=torch.float32 if dtype is None else dtype)
 
         fill_noise(net_input, noise_type)
         net_input *= var
     elif method == 'meshgrid':
-        meshgrid = get_meshgrid(spatial_size)
-        net_input = np_to_torch(meshgrid).to(torch.float32)
-        net_input = torch.concat((input_depth // 2) * (net_input,), axis=1)
+        # materialized rather than expanded: get_params may optimize over the input in place
+        meshgrid = get_meshgrid(spatial_size, device, torch.float32 if dtype is None else dtype)
+        net_input = meshgrid[None, :].repeat(1, input_depth // 2, 1, 1)
     elif method == 'fourier':
         if freq_dict['method'] == 'log':
-            freqs = freq_dict['base'] ** torch.linspace(0., freq_dict['n_freqs'] - 1, steps=freq_dict['n_freqs'])
-            net_input = generate_fourier_feature_maps(freqs, spatial_size, only_cosine=freq_dict['cosine_only'])
+            freqs = freq_dict['base'] ** torch.linspace(0., freq_dict['n_freqs'] - 1, steps=freq_dict['n_freqs'],
+                                                        device=device)
+            net_input = generate_fourier_feature_maps(freqs, spatial_size, dtype=dtype,
+                                                      only_cosine=freq_dict['cosine_only'])
         else:
             raise ValueError
 
     elif method == 'infer_freqs':
         if freq_dict['method'] == 'log':
-            net_input = freq_dict['base'] ** torch.linspace(0., freq_dict['n_freqs'] - 1, steps=freq_dict['n_freqs'])
+            net_input = freq_dict['base'] ** torch.linspace(0., freq_dict['n_freqs'] - 1, steps=freq_dict['n_freqs'],
+                                                            device=device)
         else:
             raise ValueError
 
@@ -194,14 +250,15 @@ def pil_to_np(img_PIL):
 
     From W x H x C [0...255] to C x W x H [0..1]
     '''
-    ar = np.array(img_PIL)
+    ar = np.asarray(img_PIL)
 
     if len(ar.shape) == 3:
         ar = ar.transpose(2, 0, 1)
     else:
         ar = ar[None, ...]
 
-    return ar.astype(np.float32) / 255.
+    # convert and scale in a single pass instead of astype() followed by a divide
+    return np.multiply(ar, np.float32(1. / 255.), dtype=np.float32)
 
 
 def np_to_pil(img_np):
@@ -219,23 +276,44 @@ def np_to_pil(img_np):
     return Image.fromarray(ar)
 
 
-def np_to_torch(img_np):
+def np_to_torch(img_np, pin=False):
     '''Converts image in numpy.array to torch.Tensor.
 
     From C x W x H [0..1] to  C x W x H [0..1]
+
+    The result shares memory with `img_np`. With `pin=True` it is instead copied into pinned
+    memory, so callers can move it with `.cuda(non_blocking=True)` and overlap the copy with compute.
     '''
-    return torch.from_numpy(img_np)[None, :]
+    img_var = torch.from_numpy(img_np)[None, :]
+    return img_var.pin_memory() if pin else img_var
 
 
-def torch_to_np(img_var):
+@torch.inference_mode()
+def torch_to_np(img_var, non_blocking=False):
     '''Converts an image in torch.Tensor format to np.array.
 
     From 1 x C x W x H [0..1] to  C x W x H [0..1]
+
+    With `non_blocking=True` a CUDA tensor is copied without stalling the stream; the
+    returned array is only valid after `torch.cuda.synchronize()`, so training loops
+    should batch such downloads and synchronize once before reading them.
     '''
-    return img_var.detach().cpu().numpy()[0]
+    return img_var.detach().to('cpu', non_blocking=non_blocking, copy=False).numpy()[0]
 
 
-def optimize(optimizer_type, parameters, closure, LR, num_iter, scheduler_step=-1):
+def _adam(parameters, lr):
+    '''Builds Adam with the fused CUDA kernel when all parameters live on the GPU, multi-tensor otherwise.'''
+    parameters = list(parameters)
+    fused = torch.cuda.is_available() and all(p.is_cuda for p in parameters)
+    try:
+        return torch.optim.Adam(parameters, lr=lr, fused=fused, foreach=not fused)
+    except TypeError:
+        # torch < 1.13 has no `fused` kwarg
+        return torch.optim.Adam(parameters, lr=lr)
+
+
+def optimize(optimizer_type, parameters, closure, LR, num_iter, scheduler_step=-1, warmup_iters=100,
+             warmup_opt='nadam', compile_closure=False):
     """Runs optimization loop.
 
     Args:
@@ -244,32 +322,46 @@ def optimize(optimizer_type, parameters, closure, LR, num_iter, scheduler_step=-
         closure: function, that returns loss variable
         LR: learning rate
         num_iter: number of iterations
+        warmup_iters: number of first-order steps taken before LBFGS takes over (LBFGS only)
+        warmup_opt: 'nadam' or 'adam', the optimizer used for the warm-up steps (LBFGS only).
+            LBFGS only needs a reasonable starting point, which NAdam's momentum reaches in fewer steps.
+        compile_closure: wrap the closure with torch.compile(mode='reduce-overhead') on CUDA (adam only).
+            Only worth it for closures without Python side effects, which otherwise force recompiles.
     """
 
     if optimizer_type == 'LBFGS':
-        # Do several steps with adam first
-        optimizer = torch.optim.Adam(parameters, lr=0.001)
-        for j in range(100):
-            optimizer.zero_grad()
+        # Do several steps with a first-order method first
+        if warmup_opt == 'nadam':
+            optimizer = torch.optim.NAdam(parameters, lr=0.001)
+        elif warmup_opt == 'adam':
+            optimizer = _adam(parameters, lr=0.001)
+        else:
+            assert False
+        for j in range(warmup_iters):
+            optimizer.zero_grad(set_to_none=True)
             closure()
             optimizer.step()
 
         print('Starting optimization with LBFGS')
 
         def closure2():
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             return closure()
 
-        optimizer = torch.optim.LBFGS(parameters, max_iter=num_iter, lr=LR, tolerance_grad=-1, tolerance_change=-1)
+        optimizer = torch.optim.LBFGS(parameters, max_iter=num_iter, lr=LR, tolerance_grad=-1, tolerance_change=-1,
+                                      history_size=20, line_search_fn='strong_wolfe')
         optimizer.step(closure2)
 
     elif optimizer_type == 'adam':
         print('Starting optimization with ADAM')
-        optimizer = torch.optim.Adam(parameters, lr=LR)
+        optimizer = _adam(parameters, lr=LR)
         if scheduler_step != -1:
             scheduler = torch.optim.lr_scheduler.StepLR(optimizer, scheduler_step, gamma=0.5)
+        if compile_closure and torch.cuda.is_available() and hasattr(torch, 'compile'):
+            # Capture forward + loss once so each step skips the per-op Python dispatch
+            closure = torch.compile(closure, mode='reduce-overhead', fullgraph=False)
         for j in tqdm.tqdm(range(num_iter)):
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             closure()
             optimizer.step()
             if scheduler_step != -1:
@@ -278,12 +370,54 @@ def optimize(optimizer_type, parameters, closure, LR, num_iter, scheduler_step=-
         assert False
 
 
-def generate_fourier_feature_maps(net_input, spatial_size, dtype=torch.float32, only_cosine=False):
-    meshgrid_np = get_meshgrid(spatial_size)
-    meshgrid = torch.from_numpy(meshgrid_np).permute(1, 2, 0).unsqueeze(0).type(dtype)
-    vp = net_input * torch.unsqueeze(meshgrid, -1)
-    if only_cosine:
-        vp_cat = torch.cat((torch.cos(vp),), dim=-1)
-    else:
-        vp_cat = torch.cat((torch.cos(vp), torch.sin(vp)), dim=-1)
-    return vp_cat.flatten(-2, -1).permute(0, 3, 1, 2)
+def generate_fourier_feature_maps(net_input, spatial_size, dtype=None, only_cosine=False):
+    return FourierEncoder(net_input, spatial_size, dtype=dtype, only_cosine=only_cosine)()
+
+
+class FourierEncoder(nn.Module):
+    '''Fourier feature maps of a fixed coordinate grid.
+
+    The frequency/grid product is computed once at construction, so coordinate-MLP loops that
+    re-encode every iteration only pay for the cos/sin. Build a new encoder when `spatial_size` changes.
+    The phase buffer follows device moves but ignores dtype casts such as `.half()` on the encoder or a
+    parent module; use `dtype` to choose the precision of the features.
+
+    Args:
+        freqs: 1D tensor of frequencies; the encoder is created on its device
+        spatial_size: (H, W) of the coordinate grid
+        dtype: dtype of the features; None picks bfloat16 on CUDA and float32 otherwise
+        only_cosine: drop the sine features
+    '''
+    def __init__(self, freqs, spatial_size, dtype=None, only_cosine=False):
+        super(FourierEncoder, self).__init__()
+        self.dtype = dtype
+        self.only_cosine = only_cosine
+
+        # Phases grow up to the largest frequency, far beyond what bf16 resolves, so they stay in at
+        # least fp32; only the bounded cos/sin values are stored in `dtype`.
+        phase_dtype = torch.float32 if dtype is None else torch.promote_types(dtype, torch.float32)
+        meshgrid = _cached_meshgrid(tuple(spatial_size), freqs.device, phase_dtype)
+        # phases are laid out as (coord x freq x H x W) so the output is already channel-first
+        self.register_buffer('vp', freqs.to(phase_dtype)[None, :, None, None] * meshgrid[:, None],
+                             persistent=False)
+
+    def _apply(self, fn, *args, **kwargs):
+        # The raw phases must stay in at least fp32, so `vp` only takes the device `fn` moves tensors to
+        vp = self._buffers.pop('vp')
+        try:
+            super(FourierEncoder, self)._apply(fn, *args, **kwargs)
+        finally:
+            self._buffers['vp'] = vp.to(fn(vp.new_empty(0)).device)
+        return self
+
+    def forward(self):
+        vp = self.vp
+        dtype = self.dtype
+        if dtype is None:
+            dtype = torch.bfloat16 if vp.is_cuda else torch.float32
+        n_funcs = 1 if self.only_cosine else 2
+        out = torch.empty((vp.shape[0], n_funcs) + vp.shape[1:], device=vp.device, dtype=dtype)
+        torch.cos(vp, out=out[:, 0])
+        if not self.only_cosine:
+            torch.sin(vp, out=out[:, 1])
+        return out.view(1, -1, vp.shape[-2], vp.shape[-1])